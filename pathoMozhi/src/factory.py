@@ -4,7 +4,16 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from .flamingo import Flamingo
 from .flamingo_lm import FlamingoLMMixin
-from .utils import extend_instance
+from .utils import extend_instance, getattr_recursive, setattr_recursive
+
+
+class EmbeddingFnMixin:
+    def get_input_embeddings(self):
+        return getattr_recursive(self, self._input_embeddings_attr_name)
+
+    def set_input_embeddings(self, new_embeddings):
+        setattr_recursive(self, self._input_embeddings_attr_name, new_embeddings)
+
 
 # Yeh jo function hai, yeh vision+language+adapter model ko banata hai. Hamare case mein vision element nahi hai kyunki
 # humne directly vision ke features ko load kiya hai.
@@ -35,6 +44,11 @@ def create_model_and_transforms(
         Flamingo: Flamingo model from pretrained vision and language encoders
         Image processor: Pipeline to preprocess input images
         Tokenizer: A tokenizer for the language model
+
+    Note:
+        The trainable parameter set must be final before train.py wraps the model
+        in DDP, since training uses ``static_graph=True`` and ``no_sync()`` during
+        gradient accumulation.
     """
 
     text_tokenizer = AutoTokenizer.from_pretrained(
@@ -64,16 +78,10 @@ def create_model_and_transforms(
         use_safetensors=True
     )
 
-    # hacks for MPT-1B, which doesn't have a get_input_embeddings method
-    if "mpt-1b-redpajama-200b" in lang_encoder_path:
-
-        class EmbeddingFnMixin:
-            def get_input_embeddings(self):
-                return self.transformer.wte
-
-            def set_input_embeddings(self, new_embeddings):
-                self.transformer.wte = new_embeddings
-
+    # hacks for LMs (e.g. MPT-1B) which don't have a get_input_embeddings method
+    input_embeddings_attr_name = _infer_input_embeddings_attr_name(lang_encoder_path)
+    if input_embeddings_attr_name is not None:
+        lang_encoder._input_embeddings_attr_name = input_embeddings_attr_name
         extend_instance(lang_encoder, EmbeddingFnMixin)
 
     # convert LM to FlamingoLM
@@ -127,6 +135,13 @@ def _infer_decoder_layers_attr_name(model):
     )
 
 
+def _infer_input_embeddings_attr_name(lang_encoder_path):
+    for k in __KNOWN_INPUT_EMBEDDINGS_ATTR_NAMES:
+        if k in lang_encoder_path:
+            return __KNOWN_INPUT_EMBEDDINGS_ATTR_NAMES[k]
+    return None
+
+
 __KNOWN_DECODER_LAYERS_ATTR_NAMES = {
     "opt": "model.decoder.layers",
     "gptj": "transformer.h",
@@ -138,3 +153,8 @@ __KNOWN_DECODER_LAYERS_ATTR_NAMES = {
     "mosaicgpt": "transformer.blocks",
     "biogptforcausallm": "biogpt.layers",
 }
+
+# LMs whose HF implementation lacks get_input_embeddings, keyed by a substring of the model path
+__KNOWN_INPUT_EMBEDDINGS_ATTR_NAMES = {
+    "mpt-1b-redpajama-200b": "transformer.wte",
+}
@@ -6,10 +6,11 @@ from data_utils import *
 from train_utils import get_cast_dtype
 
 class PathDataset(Dataset):
-    def __init__(self, jsonl_file, tokenizer, feature_loader, epoch=0, max_tokens=312):
+    def __init__(self, jsonl_file, tokenizer, feature_loader, epoch=0, max_tokens=312, shared_epoch=None):
         self.tokenizer = tokenizer
         self.feature_loader = feature_loader
         self.epoch = epoch
+        self.shared_epoch = shared_epoch
         self.max_tokens = max_tokens
 
     def _load_entries(self, jsonl_file):
@@ -32,7 +33,8 @@ class PathDataset(Dataset):
             "file_path": file_path,
             "text": text
         }
-        with open(f"data_log_epoch_{self.epoch}.jsonl", "a", encoding="utf-8") as log_f:
+        epoch = self.shared_epoch.get_value() if self.shared_epoch is not None else self.epoch
+        with open(f"data_log_epoch_{epoch}.jsonl", "a", encoding="utf-8") as log_f:
             log_f.write(json.dumps(log_entry) + "\n")
 
         text_encoding = self.tokenizer(
@@ -77,8 +79,9 @@ def collate_fn(batch, cast_dtype=None):
         "images": images,
     }
 
-def build_dataset(args, tokenizer, feature_loader, epoch=0, floor=False):
-    shared_epoch = SharedEpoch(epoch=epoch)
+def build_dataset(args, tokenizer, feature_loader, epoch=0, floor=False, shared_epoch=None):
+    if shared_epoch is None:
+        shared_epoch = SharedEpoch(epoch=epoch)
 
     jsonl_file = args.jsonl_file
     dataset = PathDataset(
@@ -87,6 +90,7 @@ def build_dataset(args, tokenizer, feature_loader, epoch=0, floor=False):
         feature_loader=feature_loader,
         max_tokens=args.max_tokens,
         epoch=epoch,  # Pass epoch to dataset
+        shared_epoch=shared_epoch,
     )
     dataset.epoch = epoch  # Ensure epoch is set for proper logging
 
@@ -112,9 +116,10 @@ def build_dataset(args, tokenizer, feature_loader, epoch=0, floor=False):
         shuffle=(sampler is None),
         num_workers=args.workers,
         drop_last=True,
-        prefetch_factor=4,
-        pin_memory=True,
-        persistent_workers=True,
+        # prefetch_factor / persistent_workers are only valid with worker processes
+        prefetch_factor=args.prefetch_factor if args.workers > 0 else None,
+        pin_memory=args.pin_memory,
+        persistent_workers=args.persistent_workers and args.workers > 0,
         collate_fn=lambda batch: collate_fn(batch, cast_dtype=get_cast_dtype(args.precision)),
     )
 
@@ -123,5 +128,10 @@ def build_dataset(args, tokenizer, feature_loader, epoch=0, floor=False):
 
     return DataInfo(dataloader=dataloader, sampler=sampler, shared_epoch=shared_epoch)
 
-def get_data(args, feature_loader, tokenizer, epoch=0):
-    return build_dataset(args, tokenizer, feature_loader, epoch=epoch)
+def get_data(args, feature_loader, tokenizer, epoch=0, shared_epoch=None):
+    """
+    Build the training DataInfo once; call DataInfo.set_epoch(epoch) at the start
+    of every epoch to reshuffle the sampler and advance shared_epoch, which the
+    dataset (and a SharedEpoch-backed feature loader) read inside the workers.
+    """
+    return build_dataset(args, tokenizer, feature_loader, epoch=epoch, shared_epoch=shared_epoch)
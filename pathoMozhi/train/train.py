@@ -1,23 +1,27 @@
 """ Main training script """
 
 import argparse
+import gc
+import importlib
 import os
 import random
-import wandb
 
 import torch
-torch.cuda.empty_cache()
-
 import numpy as np
 
 from data import get_data
+from data_utils import SharedEpoch
 from distributed import init_distributed_device, world_info_from_env
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from train_utils import (
     train_one_epoch,
     save_checkpoint,
     create_feature_loader,
+    get_autocast_dtype,
+    register_embedding_grad_mask,
+    expected_missing_checkpoint_keys,
 )
 from transformers import (
     get_constant_schedule_with_warmup,
@@ -49,6 +53,9 @@ def main():
     parser.add_argument("--weight_decay", type=float, default=0.01)
     parser.add_argument("--precision", type=str, default="fp32", choices=["amp_bf16", "amp_bfloat16", "bf16", "fp16", "fp32"])
     parser.add_argument("--gradient_checkpointing", action="store_true")
+    parser.add_argument("--compile", action="store_true", help="Run the training forward/backward through torch.compile.")
+    parser.add_argument("--compile_mode", type=str, default="default", choices=["default", "reduce-overhead", "max-autotune"])
+    parser.add_argument("--checkpoint_offload_cpu", action="store_true", help="Offload checkpointed activations to CPU (only for OOM cases).")
     parser.add_argument("--num_epochs", type=int, default=1)
     parser.add_argument("--logging_steps", type=int, default=100)
     parser.add_argument("--offline", action="store_true")
@@ -59,6 +66,9 @@ def main():
     parser.add_argument("--jsonl_file", type=str, required=True)
     parser.add_argument("--train_num_samples", type=int, default=10000)
     parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--persistent_workers", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--pin_memory", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--prefetch_factor", type=int, default=4)
 
     # model
     parser.add_argument("--lm_path", type=str, default="facebook/opt-1.3b")
@@ -72,6 +82,7 @@ def main():
     # distributed
     parser.add_argument("--dist-url", type=str, default="env://")
     parser.add_argument("--dist-backend", type=str, default="nccl")
+    parser.add_argument("--nccl_algo", type=str, default=None, help="Sets NCCL_ALGO (e.g. Ring, Tree) for the nccl backend.")
 
     # wandb
     parser.add_argument("--report_to_wandb", action="store_true")
@@ -92,9 +103,28 @@ def main():
         os.environ["WANDB_MODE"] = "offline"
         os.environ["TRANSFORMERS_OFFLINE"] = "1"
 
+    if args.dist_backend == "nccl":
+        # tuned defaults for large all-reduces; explicit environment settings win
+        # torch>=2.2 reads the TORCH_NCCL_ name and warns about the old one
+        if tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 2):
+            os.environ.setdefault("TORCH_NCCL_ASYNC_ERROR_HANDLING", "1")
+        else:
+            os.environ.setdefault("NCCL_ASYNC_ERROR_HANDLING", "1")
+        os.environ.setdefault("NCCL_NSOCKS_PERTHREAD", "4")
+        os.environ.setdefault("NCCL_SOCKET_NTHREADS", "2")
+        os.environ.setdefault("TORCH_NCCL_AVOID_RECORD_STREAMS", "1")
+        if args.nccl_algo is not None:
+            os.environ["NCCL_ALGO"] = args.nccl_algo
+
     args.local_rank, args.rank, args.world_size = world_info_from_env()
-    device_id = init_distributed_device(args)
     random_seed(args.seed, args.rank)
+    device_id = init_distributed_device(args)
+    if args.precision == "fp32":
+        # Let FP32 matmuls/convs run on TF32 tensor cores (Ampere+).
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
     model, tokenizer = create_model_and_transforms(
         args.lm_path,
         args.tokenizer_path if args.tokenizer_path else args.lm_path,
@@ -132,26 +162,55 @@ def main():
         print(f"Start running training on rank {args.rank}.")
         print(f"Initializing distributed training with {args.world_size} GPUs.")
 
-    if args.rank == 0 and args.report_to_wandb:
+    # only the logging rank imports wandb; other ranks get None
+    wandb = importlib.import_module("wandb") if args.report_to_wandb and args.rank == 0 else None
+    if wandb is not None:
         wandb.init(
             project=args.wandb_project,
             entity=args.wandb_entity,
             name=args.run_name,
-            config=vars(args),
+            config=args,
         )
 
+    model = model.to(device_id)
+
     resume_from_epoch = 0
     if args.resume_from_checkpoint is not None:
         if args.rank == 0:
             print(f"Loading checkpoint from {args.resume_from_checkpoint}")
-        checkpoint = torch.load(args.resume_from_checkpoint, map_location="cpu")
+        checkpoint = torch.load(args.resume_from_checkpoint, map_location="cpu", mmap=True, weights_only=True)
         msd = checkpoint["model_state_dict"]
         msd = {k.replace("module.", ""): v for k, v in msd.items()}
         resume_from_epoch = checkpoint["epoch"] + 1
-        model.load_state_dict(msd, strict=False)
-
-    model = model.to(device_id)
-    ddp_model = DDP(model, device_ids=[device_id])
+        missing, unexpected = model.load_state_dict(msd, strict=False)
+        del msd
+        unexpected_missing = set(missing) - expected_missing_checkpoint_keys(model)
+        if args.rank == 0:
+            print(f"Resumed model weights with {len(missing)} missing (frozen, not checkpointed) and {len(unexpected)} unexpected keys.")
+        if unexpected_missing or unexpected:
+            raise ValueError(
+                f"Checkpoint {args.resume_from_checkpoint} does not match the model. "
+                f"Missing trainable keys: {sorted(unexpected_missing)}. Unexpected keys: {sorted(unexpected)}"
+            )
+
+    # Only the newly added task tokens are trained in the LM input embeddings
+    if not args.freeze_lm_embeddings:
+        task_token_ids = [
+            tokenizer(token, add_special_tokens=False)["input_ids"][-1]
+            for token in ("<image>", "<|endofchunk|>")
+        ]
+        task_token_ids = torch.as_tensor(task_token_ids, dtype=torch.long, device=device_id)
+        register_embedding_grad_mask(model.lang_encoder.get_input_embeddings(), task_token_ids)
+
+    # The trainable parameter set is fixed at this point and every trainable
+    # parameter takes part in each forward, so the graph can be treated as static.
+    ddp_model = DDP(
+        model,
+        device_ids=[device_id],
+        gradient_as_bucket_view=True,
+        static_graph=True,
+        bucket_cap_mb=50,
+    )
 
     if args.gradient_checkpointing:
         from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
@@ -161,7 +220,7 @@ def main():
 
         non_reentrant_wrapper = functools.partial(
             checkpoint_wrapper,
-            offload_to_cpu=True,
+            offload_to_cpu=args.checkpoint_offload_cpu,
             checkpoint_impl=CheckpointImpl.NO_REENTRANT,
         )
         apply_activation_checkpointing(
@@ -170,17 +229,32 @@ def main():
             check_fn=lambda m: getattr(m, "_use_gradient_checkpointing", False),
         )
 
+    # Checkpoints are saved from the uncompiled ddp_model so state_dict keys stay unprefixed.
+    # The number of feature tiles per slide is not fixed, so shapes are left to dynamo.
+    train_model = ddp_model
+    if args.compile:
+        train_model = torch.compile(ddp_model, mode=args.compile_mode, fullgraph=False)
+
+    # The row-masked input embedding must not be weight-decayed, otherwise AdamW's
+    # decoupled decay still shrinks the frozen rows although their grads are zero.
+    masked_param_ids = set()
+    if not args.freeze_lm_embeddings:
+        masked_param_ids.add(id(model.lang_encoder.get_input_embeddings().weight))
+
     def get_grouped_params(named_params, base_lr, wd, gate_lr=None, gate_lr_mult=1.0):
         decay, no_decay, gate = [], [], []
+        gate_suffixes = {"attn_gate": gate, "ff_gate": gate}
         for n, p in named_params:
-            if not p.requires_grad:
+            if not p.requires_grad or getattr(p, "exclude_from_optimizer", False):
                 continue
-            if n.endswith("attn_gate") or n.endswith("ff_gate"):
-                gate.append(p)
-            elif p.ndim == 1 or n.endswith(".bias") or "norm" in n.lower():
-                no_decay.append(p)
-            else:
-                decay.append(p)
+            bucket = gate_suffixes.get(n.rpartition(".")[-1])
+            if bucket is None:
+                n_lower = n.lower()
+                if id(p) in masked_param_ids or p.ndim == 1 or n_lower.endswith(".bias") or "norm" in n_lower:
+                    bucket = no_decay
+                else:
+                    bucket = decay
+            bucket.append(p)
         lr_gate = gate_lr if gate_lr is not None else base_lr * gate_lr_mult
         return [
             {"params": decay, "weight_decay": wd, "lr": base_lr},
@@ -188,15 +262,21 @@ def main():
             {"params": gate, "weight_decay": 0.0, "lr": lr_gate},
         ]
 
-    params_to_optimize = list(
-        filter(lambda x: x[1].requires_grad and not getattr(x[1], "exclude_from_optimizer", False),
-               ddp_model.named_parameters())
-    )
-
-    optimizer = torch.optim.AdamW(
-        get_grouped_params(params_to_optimize, args.learning_rate, args.weight_decay, gate_lr=args.gate_learning_rate),
-        betas=(0.9, 0.999)
-    )
+    def build_optimizer(**impl_kwargs):
+        # fresh groups per attempt: Optimizer.__init__ writes its defaults into the group dicts
+        param_groups = get_grouped_params(ddp_model.named_parameters(), args.learning_rate, args.weight_decay, gate_lr=args.gate_learning_rate)
+        if args.world_size > 1:
+            # ZeRO-1: shard the AdamW state across ranks instead of replicating it
+            return ZeroRedundancyOptimizer(
+                param_groups, optimizer_class=torch.optim.AdamW, betas=(0.9, 0.999), **impl_kwargs
+            )
+        return torch.optim.AdamW(param_groups, betas=(0.9, 0.999), **impl_kwargs)
+
+    try:
+        optimizer = build_optimizer(fused=True)
+    except (TypeError, RuntimeError):
+        # fused kernels need a recent torch and CUDA params
+        optimizer = build_optimizer(foreach=True)
 
     if args.rank == 0:
         for i, group in enumerate(optimizer.param_groups):
@@ -240,22 +320,41 @@ def main():
             optimizer, num_warmup_steps=args.warmup_steps
         )
 
+    # bf16 autocast keeps FP32 master weights and needs no loss scaling;
+    # fp16 autocast additionally requires a GradScaler.
+    amp_dtype = get_autocast_dtype(args.precision)
+    scaler = torch.cuda.amp.GradScaler() if args.precision == "fp16" else None
+
     if args.resume_from_checkpoint is not None and "lr_scheduler_state_dict" in checkpoint:
         lr_scheduler.load_state_dict(checkpoint["lr_scheduler_state_dict"])
+    if args.resume_from_checkpoint is not None and scaler is not None and "scaler_state_dict" in checkpoint:
+        scaler.load_state_dict(checkpoint["scaler_state_dict"])
+
+    # Release the resume checkpoint (incl. the optimizer moments) before training
+    if args.resume_from_checkpoint is not None:
+        del checkpoint
+        gc.collect()
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
     ddp_model.train()
 
+    # Build the data pipeline once; the epoch-dependent feature path is resolved
+    # through shared_epoch, which set_epoch() advances every epoch.
+    shared_epoch = SharedEpoch(epoch=resume_from_epoch)
+    train_feature_loader = create_feature_loader(args.vision_features, epoch=shared_epoch, augment=False)
+    train_dataset = get_data(args, train_feature_loader, tokenizer, epoch=resume_from_epoch, shared_epoch=shared_epoch)
+    train_loader = train_dataset.dataloader
+
     for epoch in range(resume_from_epoch, args.num_epochs):
-        train_feature_loader = create_feature_loader(args.vision_features, epoch=epoch, augment=False)
-        train_dataset = get_data(args, train_feature_loader, tokenizer, epoch=epoch)
         if args.rank == 0:
             print(f"[Epoch {epoch}] Using vision feature path: {args.vision_features.format(epoch=epoch)}")
         train_dataset.set_epoch(epoch)
-        train_loader = train_dataset.dataloader
 
         train_one_epoch(
             args=args,
-            model=ddp_model,
+            model=train_model,
             epoch=epoch,
             tokenizer=tokenizer,
             optimizer=optimizer,
@@ -263,9 +362,11 @@ def main():
             train_loader=train_loader,
             device_id=device_id,
             wandb=wandb,
+            amp_dtype=amp_dtype,
+            scaler=scaler,
         )
-        save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args)
-    save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args)
+        save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args, wandb=wandb, scaler=scaler)
+    save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args, wandb=wandb, scaler=scaler)
 
 if __name__ == "__main__":
     main()
@@ -1,20 +1,23 @@
 import time
-from contextlib import suppress
+from contextlib import nullcontext
 import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from tqdm import tqdm
 import os
-import wandb
 
-def create_feature_loader(base_path_template: str, epoch: int = 0, augment: bool = False):
+def create_feature_loader(base_path_template: str, epoch=0, augment: bool = False):
     """
     Loads .pt features from the specified list of base path templates.
+    epoch may be an int or a SharedEpoch; with a SharedEpoch the {epoch} path
+    is resolved on every call, so one loader can be reused across epochs.
     """
     base_path_template = base_path_template.split(",")
     def feature_loader(file_path: str):
+        current_epoch = epoch.get_value() if hasattr(epoch, "get_value") else epoch
         filename = file_path.replace(".h5", ".pt")
         pt_file = None
         for base_path in base_path_template:
-            candidate_path = os.path.join(base_path.format(epoch=epoch), filename)
+            candidate_path = os.path.join(base_path.format(epoch=current_epoch), filename)
             if os.path.exists(candidate_path):
                 pt_file = candidate_path
                 break
@@ -23,7 +26,7 @@ def create_feature_loader(base_path_template: str, epoch: int = 0, augment: bool
         try:
             data = torch.load(pt_file, map_location="cpu", weights_only=True)
         except (EOFError, RuntimeError) as e:
-            print(f"[ERROR: torch.load failed] Epoch: {epoch}, File: {pt_file}, Error: {e}")
+            print(f"[ERROR: torch.load failed] Epoch: {current_epoch}, File: {pt_file}, Error: {e}")
             raise e
         if isinstance(data, dict) and "features" in data:
             feats = data["features"]
@@ -65,15 +68,33 @@ def get_mp_policy_dtype(precision: str):
     else:
         return torch.float32
 
-def get_autocast(precision, cache_enabled=True):
-    if precision == "amp":
-        return torch.cuda.amp.autocast(cache_enabled=cache_enabled)
-    elif precision in ["amp_bfloat16", "amp_bf16"]:
-        return lambda: torch.cuda.amp.autocast(
-            dtype=torch.bfloat16, cache_enabled=cache_enabled
-        )
-    else:
-        return suppress
+def get_autocast_dtype(precision: str):
+    if precision.startswith(("amp_bf", "bf")):
+        return torch.bfloat16
+    elif precision == "fp16":
+        return torch.float16
+    return None
+
+def register_embedding_grad_mask(embedding, trainable_token_ids):
+    """
+    Restrict embedding updates to the given token rows by zeroing the gradient
+    of every other row in a backward hook (requires_grad is per-tensor, so rows
+    cannot be frozen individually). trainable_token_ids is a long tensor on the
+    embedding's device.
+    """
+    frozen = torch.ones(embedding.num_embeddings, dtype=torch.bool, device=trainable_token_ids.device)
+    frozen.index_fill_(0, trainable_token_ids, False)
+    frozen_idx = frozen.nonzero().squeeze(1)
+    return embedding.weight.register_hook(lambda grad: grad.index_fill(0, frozen_idx, 0.0))
+
+def grad_sync_context(model, is_accumulation_boundary):
+    """
+    Skip the DDP gradient all-reduce on every microstep except the one that
+    closes a gradient accumulation window.
+    """
+    if is_accumulation_boundary or not hasattr(model, "no_sync"):
+        return nullcontext()
+    return model.no_sync()
 
 def train_one_epoch(
     args,
@@ -85,18 +106,15 @@ def train_one_epoch(
     lr_scheduler,
     device_id,
     wandb,
+    amp_dtype=None,
+    scaler=None,
 ):
     # setup loader
     num_batches_per_epoch = train_loader.num_batches
     print("Number of batches in training dataset: ", num_batches_per_epoch)
 
-    autocast = get_autocast(args.precision)
     cast_dtype = get_cast_dtype(args.precision)
 
-    # setup model
-    media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
-    endofchunk_token_id = tokenizer("<|endofchunk|>", add_special_tokens=False)["input_ids"][-1]
-
     model.train()
 
     # setup logging
@@ -122,47 +140,53 @@ def train_one_epoch(
         attention_mask = batch["attention_mask"].to(device_id, non_blocking=True)
         labels = batch["labels"].to(device_id, non_blocking=True)
 
-        with autocast():
-            output = model(
-                vision_x=images,
-                lang_x=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )
-            loss = output["loss"]
-
-            if args.lambda_gate > 0:
-                #print("[DEBUG] Applying gate regularization")
-                all_attn_gates = [
-                    layer.attn_gate for layer in model.module.lang_encoder.gated_cross_attn_layers
-                    if layer is not None
-                ]
-                gate_reg_loss = -torch.stack([gate.tanh() for gate in all_attn_gates]).mean()
-                loss = loss + args.lambda_gate * gate_reg_loss
-
-            # if loss is nan, skip this batch
-            if torch.isnan(loss):
-                optimizer.zero_grad(set_to_none=True)
-                continue
-
-        divided_loss = loss / args.gradient_accumulation_steps
-        (divided_loss).backward()
-
-        if not args.freeze_lm_embeddings:
-            embed_grad = model.module.lang_encoder.get_input_embeddings().weight.grad
-            zero_mask = torch.zeros_like(embed_grad)
-            zero_mask[media_token_id] = torch.ones_like(zero_mask[media_token_id])
-            zero_mask[endofchunk_token_id] = torch.ones_like(zero_mask[endofchunk_token_id])
-            model.module.lang_encoder.get_input_embeddings().weight.grad = embed_grad * zero_mask
-
-        # clip gradient norm
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        is_accumulation_boundary = (((local_step + 1) % args.gradient_accumulation_steps) == 0) or (
+            local_step == num_batches_per_epoch - 1
+        )
+
+        # DDP arms the gradient all-reduce in forward, so both forward and
+        # backward have to run inside the sync context.
+        with grad_sync_context(model, is_accumulation_boundary):
+            with torch.autocast("cuda", dtype=amp_dtype, enabled=amp_dtype is not None):
+                output = model(
+                    vision_x=images,
+                    lang_x=input_ids,
+                    attention_mask=attention_mask,
+                    labels=labels,
+                )
+                loss = output["loss"]
+
+                if args.lambda_gate > 0:
+                    #print("[DEBUG] Applying gate regularization")
+                    all_attn_gates = [
+                        layer.attn_gate for layer in model.module.lang_encoder.gated_cross_attn_layers
+                        if layer is not None
+                    ]
+                    gate_reg_loss = -torch.stack([gate.tanh() for gate in all_attn_gates]).mean()
+                    loss = loss + args.lambda_gate * gate_reg_loss
+
+                # if loss is nan, skip this batch
+                if torch.isnan(loss):
+                    optimizer.zero_grad(set_to_none=True)
+                    continue
+
+            divided_loss = loss / args.gradient_accumulation_steps
+            if scaler is not None:
+                scaler.scale(divided_loss).backward()
+            else:
+                (divided_loss).backward()
 
         # step optimizer and log
-        if (((local_step + 1) % args.gradient_accumulation_steps) == 0) or (
-            local_step == num_batches_per_epoch - 1
-        ):
-            optimizer.step()
+        if is_accumulation_boundary:
+            # clip gradient norm once the grads have been averaged across ranks
+            if scaler is not None:
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                optimizer.step()
             lr_scheduler.step()
             optimizer.zero_grad(set_to_none=True)
 
@@ -171,7 +195,7 @@ def train_one_epoch(
             end = time.time()
 
             # rank 0 logging
-            if args.rank == 0 and args.report_to_wandb:
+            if wandb is not None:
 
                 samples_per_second_per_gpu = (
                     args.gradient_accumulation_steps
@@ -259,14 +283,36 @@ def filter_state_dict_to_trainable(model, state_dict):
     return state_dict
 
 
-def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
+def expected_missing_checkpoint_keys(model):
+    """
+    Keys that filter_state_dict_to_trainable drops when saving, i.e. the keys a
+    resumed checkpoint is allowed to be missing.
+    """
+    expected = {
+        name for name, p in model.named_parameters()
+        if not p.requires_grad and "embed" not in name
+    }
+    expected.update(
+        n
+        for n in model.state_dict().keys()
+        if ("lang_encoder.old_decoder_blocks" in n)
+        or ("lang_encoder.gated_cross_attn_layers" in n)
+        or ("vision_encoder" in n)
+    )
+    return expected
+
+
+def save_checkpoint(model, optimizer, lr_scheduler, epoch, args, wandb=None, scaler=None):
     """
-    Save training checkpoint with model, optimizer, and lr_scheduler state.
+    Save training checkpoint with model, optimizer, lr_scheduler and (fp16) GradScaler state.
     """
     model_state = model.state_dict()
-    optim_state = optimizer.state_dict()
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        # gather the sharded optimizer state on rank 0 (collective, all ranks must call)
+        optimizer.consolidate_state_dict(to=0)
 
     if args.rank == 0:
+        optim_state = optimizer.state_dict()
         model_state = filter_state_dict_to_trainable(model, model_state)
 
         if not os.path.exists(args.run_name):
@@ -278,10 +324,12 @@ def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
             "optimizer_state_dict": optim_state,
             "lr_scheduler_state_dict": lr_scheduler.state_dict(),
         }
+        if scaler is not None:
+            checkpoint_dict["scaler_state_dict"] = scaler.state_dict()
 
         print(f"Saving checkpoint to {args.run_name}/checkpoint_{epoch}.pt")
         torch.save(checkpoint_dict, f"{args.run_name}/checkpoint_{epoch}.pt")
-        if args.report_to_wandb and args.save_checkpoints_to_wandb:
+        if wandb is not None and args.save_checkpoints_to_wandb:
             wandb.save(f"{args.run_name}/checkpoint_{epoch}.pt")
 
         if args.delete_previous_checkpoint: